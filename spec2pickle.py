@@ -1,15 +1,38 @@
-import sys, specparser, pickle
+import sys, specparser, pickle, array
 
-def spec2pickle(infname, outfname):
+class _ArrayPickler(pickle.Pickler):
+    """Pickler which stores arrays as binary strings instead of lists.
+
+    The byte order and item size are stored with the data, so that
+    the arrays can be loaded on other platforms.
+    """
+    dispatch = pickle.Pickler.dispatch.copy()
+
+    def save_array(self, obj):
+        self.save_reduce(specparser._rebuild_array, (obj.typecode,
+            obj.tostring(), sys.byteorder, obj.itemsize), obj=obj)
+
+    dispatch[array.array] = save_array
+
+def spec2pickle(infname, outfname, dtypes=None):
     p = specparser.Specparser(open(infname))
+    if dtypes != None:
+        p.dtypes = { None : dtypes }
     dd = p.parse()
-    fout = open(outfname, 'w')
-    pickle.dump(dd, fout)
+    fout = open(outfname, 'wb')
+    if dtypes == None:
+        pickle.dump(dd, fout)
+    else:
+        # Binary protocol stores the array strings compactly
+        _ArrayPickler(fout, 2).dump(dd)
     fout.close()
 
 def main():
-    spec2pickle(sys.argv[1], sys.argv[2])
+    """Usage: spec2pickle.py SPECFILE PICKLEFILE [auto|float32]"""
+    if len(sys.argv) > 3:
+        spec2pickle(sys.argv[1], sys.argv[2], sys.argv[3])
+    else:
+        spec2pickle(sys.argv[1], sys.argv[2])
 
 if __name__ == "__main__":
     main()
-
@@ -1,9 +1,17 @@
-import re, logging, time, datetime
+from __future__ import with_statement
+import re, logging, time, datetime, threading, math, hashlib, array
+import calendar
+import os, sys, collections, tempfile, mmap, struct, bisect, itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Exceptions emitted by the parser
 class ParseError(Exception):
     """Raised when the parser encounters a line which it cannot interpret"""
     def __init__(self, line):
+        Exception.__init__(self, line)
         self.line = line
     def __str__(self):
         return repr(self.line)
@@ -16,6 +24,15 @@ class ScanEnd(Exception):
     """Raised when end of scan is encountered when reading points"""
     pass
 
+class LoadError(Exception):
+    """Returned by :func:`load_many` in place of a file which failed to load"""
+    def __init__(self, path, error):
+        Exception.__init__(self, path, error)
+        self.path = path
+        self.error = error
+    def __str__(self):
+        return '%s: %s' % (self.path, repr(self.error))
+
 
 class ScanDict(dict):
     """Multi-value dict with syntactic sugar for getting items.
@@ -72,6 +89,45 @@ class ScanDict(dict):
     def items(self):
         return zip(self.keys(), self.values())
 
+    def __reduce__(self):
+        # Default pickling would restore the items with __setitem__,
+        # wrapping each value list into another list
+        return (_rebuild_scandict, (dict(dict.items(self)), self.__dict__))
+
+
+def _rebuild_scandict(raw, attrs):
+    """Unpickle helper for :class:`ScanDict`"""
+    sd = ScanDict()
+    for k, v in raw.items():
+        sd.setraw(k, v)
+    sd.__dict__.update(attrs)
+    return sd
+
+
+# struct format characters of integers, keyed by (size, signed)
+_STRUCT_INTS = { (1, True) : 'b', (2, True) : 'h', (4, True) : 'i',
+                 (8, True) : 'q', (1, False) : 'B', (2, False) : 'H',
+                 (4, False) : 'I', (8, False) : 'Q' }
+
+def _rebuild_array(typecode, data, byteorder, itemsize):
+    """Unpickle helper for arrays stored as bytes (see spec2pickle.py)
+
+    `byteorder` and `itemsize` are those of the machine which wrote the
+    array. Values are byte swapped or converted to the native item size
+    as needed, values which do not fit raise OverflowError.
+    """
+    arr = array.array(typecode)
+    if arr.itemsize == itemsize:
+        arr.fromstring(data)
+        if byteorder != sys.byteorder:
+            arr.byteswap()
+        return arr
+    # Integer type with a different size, e.g. 'l' from a 64-bit machine
+    fmt = '%s%d%s' % ('<' if byteorder == 'little' else '>',
+        len(data) // itemsize, _STRUCT_INTS[itemsize, typecode.islower()])
+    arr.fromlist(list(struct.unpack(fmt, data)))
+    return arr
+
 
 def is_blankline(line):
     m = re.match('^\W*$', line)
@@ -79,6 +135,343 @@ def is_blankline(line):
 
 WAITTIME = 1.0
 
+_MONTHS = dict([ (m, i+1) for i, m in
+    enumerate('Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()) ])
+_WEEKDAYS = frozenset('Mon Tue Wed Thu Fri Sat Sun'.split())
+
+# Seconds since epoch at the start of an hour, keyed by
+# (year, month, day, hour). Must be cleared if the time zone is changed.
+_hour_epochs = {}
+
+def _hour_epoch(year, month, day, hour):
+    key = (year, month, day, hour)
+    base = _hour_epochs.get(key)
+    if base == None:
+        base = time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
+        _hour_epochs[key] = base
+    return base
+
+def parse_date(s):
+    """Return seconds since epoch (in local time) of a #D date string.
+
+    Dates in the format written by SPEC, e.g. 'Thu Feb 25 14:20:14 2010',
+    are converted with a fast path which calls :func:`time.mktime` only
+    once for each hour. Other formats understood by :func:`time.strptime`
+    are converted with it, invalid dates raise ValueError.
+    """
+    try:
+        wday, mon, day, hms, year = s.split()
+        hour, mins, secs = hms.split(':')
+        year, month, day = int(year), _MONTHS[mon], int(day)
+        hour, mins, secs = int(hour), int(mins), int(secs)
+        if wday in _WEEKDAYS and 1 <= day <= calendar.monthrange(year, month)[1] \
+                and 0 <= hour < 24 and 0 <= mins < 60 and 0 <= secs <= 61:
+            return _hour_epoch(year, month, day, hour) + 60*mins + secs
+    except (ValueError, KeyError):
+        pass
+    # Let strptime handle other formats and reject invalid dates
+    return time.mktime(time.strptime(s))
+
+
+# Array typecodes of integers and floats, and the other dtype policies
+_INT_TYPECODES = frozenset('bBhHiIlL')
+_FLOAT_TYPECODES = frozenset('fd')
+_DTYPE_POLICIES = frozenset(['auto', 'float32'])
+
+def _check_dtypes(dtypes):
+    """Raise ValueError if a dtypes dictionary contains an unknown policy,
+    see :attr:`Specparser.dtypes`."""
+    for c, policy in dtypes.items():
+        if policy not in _INT_TYPECODES and policy not in _FLOAT_TYPECODES \
+                and policy not in _DTYPE_POLICIES:
+            raise ValueError('Unknown dtype policy %s for counter %s'
+                             % (repr(policy), repr(c)))
+
+
+def _int_typecode(vals):
+    """Return the smallest array typecode of 'i' and 'l' which can hold
+    the values, or None if they are not all integers or do not fit."""
+    for v in vals:
+        if not v.is_integer():
+            return None
+    lo, hi = min(vals), max(vals)
+    for tc in ('i', 'l'):
+        bits = 8*array.array(tc).itemsize
+        if -2**(bits-1) <= lo and hi < 2**(bits-1):
+            return tc
+    return None
+
+
+def lossless(vals, typecode):
+    """Return True if the float values `vals` can be stored in an array
+    with `typecode` without changing them.
+
+    Raises ValueError if `typecode` is not an integer or float typecode.
+    """
+    if typecode not in _INT_TYPECODES and typecode not in _FLOAT_TYPECODES:
+        raise ValueError('Not a numeric array typecode: %s' % repr(typecode))
+    try:
+        if typecode in _INT_TYPECODES:
+            for v in vals:
+                if not float(v).is_integer():
+                    return False
+            conv = array.array(typecode, [ int(v) for v in vals ])
+        else:
+            conv = array.array(typecode, vals)
+    except OverflowError:
+        return False
+    return conv.tolist() == list(vals)
+
+
+def _convert_counter(vals, policy):
+    """Return a float array `vals` converted according to a dtype policy,
+    see :attr:`Specparser.dtypes`."""
+    if policy in _DTYPE_POLICIES:
+        typecode = len(vals) and _int_typecode(vals)
+        if not typecode:
+            typecode = 'f' if policy == 'float32' else 'd'
+    else:
+        typecode = policy
+    if typecode == vals.typecode:
+        return vals
+    if typecode in _INT_TYPECODES:
+        if not lossless(vals, typecode):
+            logging.warning('Counter values do not fit in array of type %s'
+                            % typecode)
+            return vals
+        return array.array(typecode, [ int(v) for v in vals ])
+    conv = array.array(typecode, vals.tolist())
+    # Single precision loses digits, but values must not become infinite
+    for v, c in zip(vals, conv):
+        if math.isinf(c) and not math.isinf(v):
+            logging.warning('Counter values do not fit in array of type %s'
+                            % typecode)
+            return vals
+    return conv
+
+
+_MCA_CHARS = '0123456789.eE+- \t\r\n'
+
+def decode_mca(text):
+    """Return an array of floats from a string of whitespace separated
+    MCA channel values.
+
+    If numpy is available, strings of plain decimal numbers are converted
+    in bulk with numpy.fromstring(), otherwise value by value. Invalid
+    values raise ValueError.
+    """
+    # numpy.fromstring() silently stops at invalid values, so use it
+    # only when the string contains nothing but digits and separators,
+    # and check that it converted every value. The sentinel value at the
+    # end catches a malformed last value, which would be partly converted.
+    if numpy != None and not text.translate(None, _MCA_CHARS):
+        vals = numpy.fromstring(text + ' 0', sep=' ')
+        if len(vals) == len(text.split()) + 1:
+            return array.array('d', vals[:-1].tostring())
+    return array.array('d', map(float, text.split()))
+
+
+def read_mca(path, lineno):
+    """Return the MCA spectrum starting from line `lineno` (counted from
+    0, see :attr:`Specparser.lineno`) of the spec-file in `path` as an
+    array of floats.
+
+    Used for spectra read with the 'index' :attr:`Specparser.mcamode`.
+    Raises ValueError if the line does not start an MCA spectrum.
+    """
+    fid = open(path)
+    try:
+        lines = itertools.islice(fid, lineno, None)
+        cl = next(lines, '').rstrip('\r\n')
+        if cl[:2] != '@A':
+            raise ValueError('No MCA spectrum on line %d' % lineno)
+        parts = cl.split(None, 1)[1:]
+        while cl.endswith('\\'):
+            cl = next(lines, '').rstrip('\r\n')
+            parts.append(cl)
+    finally:
+        fid.close()
+    return decode_mca(' '.join(parts).replace('\\', ' '))
+
+# Parsed #On motor name lists, keyed by the raw text of the #On lines,
+# in least recently used order. Shared between all parser instances
+# (and threads) in a process, holds at most MOTORNAMES_CACHESIZE lists.
+MOTORNAMES_CACHESIZE = 32
+_motornames_cache = collections.OrderedDict()
+_motornames_lock = threading.Lock()
+
+def _split_motornames(rawlines):
+    """Return a list of motor names from a list of #On line values"""
+    key = '\n'.join(rawlines)
+    with _motornames_lock:
+        motorlist = _motornames_cache.pop(key, None)
+        if motorlist is not None:
+            _motornames_cache[key] = motorlist
+    if motorlist is None:
+        motorlist = []
+        for lval in rawlines:
+            # Motor names are separated by two spaces
+            motorlist.extend(re.split(r'  +', lval))
+        with _motornames_lock:
+            _motornames_cache[key] = motorlist
+            while len(_motornames_cache) > MOTORNAMES_CACHESIZE:
+                _motornames_cache.popitem(last=False)
+    return list(motorlist)
+
+
+class Accumulator(object):
+    """Base class for online accumulators of scan point values.
+
+    Accumulators compute a summary value for a scan point by point,
+    without storing the points. They are used by setting the
+    :attr:`Specparser.accumulators` attribute.
+
+    The accumulated value is taken from the counter `column`, optionally
+    divided by the value of counter `norm` (e.g. 'Monitor') at each point.
+    Points where the `norm` counter is zero (e.g. during a beam dump) are
+    skipped.
+    Accumulators which depend on the scanned variable take it from column
+    `x`, by default the first column in the scan.
+
+    Subclasses implement :meth:`clear`, :meth:`add` and :meth:`value`.
+    """
+    def __init__(self, column, x=None, norm=None):
+        self.column = column
+        self.x = x
+        self.norm = norm
+
+    def reset(self, columns):
+        """Start a new scan with counters named in the list `columns`.
+
+        Returns False if the scan does not have the required columns.
+        """
+        try:
+            self._yind = columns.index(self.column)
+            self._xind = columns.index(self.x) if self.x != None else 0
+            self._nind = columns.index(self.norm) if self.norm != None \
+                else None
+        except ValueError:
+            return False
+        self.clear()
+        return True
+
+    def update(self, pts):
+        """Add a point to the state, unless its `norm` counter is zero."""
+        if self.norm != None and pts[self._nind] == 0.0:
+            return
+        self.add(pts)
+
+    def _y(self, pts):
+        if self._nind == None:
+            return pts[self._yind]
+        return pts[self._yind] / pts[self._nind]
+
+    def clear(self):
+        """Clear the accumulated state."""
+        raise NotImplementedError
+
+    def add(self, pts):
+        """Add a point with a list of counter values `pts` to the state."""
+        raise NotImplementedError
+
+    def value(self):
+        """Return the summary value for the points added so far."""
+        raise NotImplementedError
+
+
+class Sum(Accumulator):
+    """Sum (integrated counts) of a counter."""
+    def clear(self):
+        self.total = 0.0
+    def add(self, pts):
+        self.total += self._y(pts)
+    def value(self):
+        return self.total
+
+
+class Mean(Sum):
+    """Mean of a counter, None for an empty scan."""
+    def clear(self):
+        Sum.clear(self)
+        self.n = 0
+    def add(self, pts):
+        Sum.add(self, pts)
+        self.n += 1
+    def value(self):
+        if self.n == 0:
+            return None
+        return self.total / self.n
+
+
+class Min(Accumulator):
+    """Minimum of a counter, None for an empty scan."""
+    def clear(self):
+        self.val = None
+    def add(self, pts):
+        y = self._y(pts)
+        if self.val == None or y < self.val:
+            self.val = y
+    def value(self):
+        return self.val
+
+
+class Max(Accumulator):
+    """Maximum of a counter, None for an empty scan."""
+    def clear(self):
+        self.val = None
+        self.arg = None
+    def add(self, pts):
+        y = self._y(pts)
+        if self.val == None or y > self.val:
+            self.val = y
+            self.arg = pts[self._xind]
+    def value(self):
+        return self.val
+
+
+class ArgMax(Max):
+    """Value of the scanned variable at the (first) maximum of a counter."""
+    def value(self):
+        return self.arg
+
+
+class Centroid(Accumulator):
+    """Centroid of a counter with respect to the scanned variable.
+
+    None if the counter sums to zero.
+    """
+    def clear(self):
+        self.sy = 0.0
+        self.sxy = 0.0
+        self.sxxy = 0.0
+    def add(self, pts):
+        x = pts[self._xind]
+        y = self._y(pts)
+        self.sy += y
+        self.sxy += x*y
+        self.sxxy += x*x*y
+    def value(self):
+        if self.sy == 0.0:
+            return None
+        return self.sxy / self.sy
+
+
+class FWHM(Centroid):
+    """Full width at half maximum of a counter as a function of the scanned
+    variable.
+
+    The width is estimated from the second moment of the counter around
+    its centroid, assuming a Gaussian peak shape. None if the counter
+    sums to zero.
+    """
+    def value(self):
+        if self.sy == 0.0:
+            return None
+        c = self.sxy / self.sy
+        var = max(self.sxxy / self.sy - c*c, 0.0)
+        return 2.0*math.sqrt(2.0*math.log(2.0)*var)
+
+
 class Specparser:
     """Parses a scan file from SPEC.
 
@@ -113,6 +506,40 @@ class Specparser:
     :attr:`lineno`
         Current position in the file as line number.
 
+    :attr:`accumulators`
+        Dictionary of :class:`Accumulator` instances, or None. If set,
+        scan points are not stored in the 'counters' of scans, instead
+        the values of the accumulators are stored in 'summary' dictionary
+        of each scan, with the same keys as in this dictionary.
+
+    :attr:`dtypes`
+        None (default) to store counter values in lists of floats, or a
+        dictionary with column names as keys and :mod:`array` typecodes
+        or policies as values, to store the values in arrays. Columns
+        which are not in the dictionary use the value of key None, by
+        default 'auto'. With the 'auto' policy, columns where all values
+        are integers are stored in integer arrays ('i' or 'l', whichever
+        fits) and other columns as doubles ('d'). The 'float32' policy is
+        like 'auto', but stores the non-integer columns as single
+        precision floats ('f'), which may lose precision, see
+        :func:`lossless`. Columns with an integer or 'f' typecode are
+        kept as doubles, with a warning, if their values are not integers
+        or do not fit. Other typecodes and policies raise ValueError
+        when the next scan header is read. The values are converted when
+        the end of the scan is read, and the typecodes are stored in the
+        'dtypes' dictionary of the scan.
+
+    :attr:`mcamode`
+        How MCA spectra (@A lines) in scans are read, one of 'array'
+        (default), 'text', 'index' or 'skip'. With 'array', the spectra
+        are decoded into arrays of floats. With 'text', the channel values
+        are kept as a string, which can be decoded later with
+        :func:`decode_mca`, but takes more memory than the decoded array.
+        With 'index', only the line number of the @A line of each
+        spectrum is stored, and the spectrum can be read later from the
+        file with :func:`read_mca`. With 'skip', the spectra are not
+        stored.
+
     See http://www.certif.com/spec_manual/user_1_4_1.html for a rough
     description of the file format.
     """
@@ -136,8 +563,22 @@ class Specparser:
         self.curheader = {}
         self.curscan = None
         self.lineno = -1
+        self.accumulators = None
+        self.mcamode = 'array'
+        self.dtypes = None
         # Private variables
         self.__curline = None
+        self.__rawline = None
+        # Hash object of the current header or scan block, and whether
+        # the current line has been added to it
+        self.__hash = None
+        self.__hashed = False
+        # Hash object of the data and spectrum lines of the current scan
+        self.__datahash = None
+        # (key, accumulator) pairs applicable to the current scan
+        self.__active = None
+        # MCA spectra read before the next point
+        self.__mcapending = []
         # Get first line
         self.__getline()
 
@@ -150,28 +591,108 @@ class Specparser:
 
     def __getline(self):
         """Return the next line, or raise InputTimeout exception"""
+        if self.__hash != None and not self.__hashed:
+            self.__hash.update(self.__rawline)
+            self.__hashed = True
         try:
-            self.__curline = (self.__fid.next())[:-1] # Clip the newline
-            self.lineno = self.lineno + 1
+            raw = self.__fid.next()
         except StopIteration:
             if self.timeout <= 0.0:
                 raise(InputTimeout)
-            starttime = time.clock()
+            starttime = time.time()
             while True:
                 time.sleep(WAITTIME)
                 try:
-                    self.__curline = self.__fid.next()
+                    raw = self.__fid.next()
                     break
                 except StopIteration:
-                    if (time.clock() - starttime) > self.timeout:
+                    if (time.time() - starttime) > self.timeout:
                         raise(InputTimeout)
+        self.__rawline = raw
+        self.__hashed = False
+        self.__curline = raw[:-1] # Clip the newline
+        self.lineno = self.lineno + 1
         return self.__curline
 
 
+    def __start_hash(self):
+        """Start hashing lines, beginning from the current line."""
+        self.__hash = hashlib.md5()
+
+
+    def __end_hash(self):
+        """Return the hex digest of the lines consumed since
+        :meth:`__start_hash` and stop hashing."""
+        digest = self.__hash.hexdigest()
+        self.__hash = None
+        return digest
+
+
+    def __close_scan(self):
+        if self.__mcapending:
+            logging.warning('MCA spectra without a point at end of scan')
+            self.curscan['mca_unpaired'] = self.__mcapending
+            self.__mcapending = []
+        if self.dtypes != None:
+            counters = self.curscan['counters']
+            self.curscan['dtypes'] = {}
+            for c in self.curscan['columns']:
+                policy = self.dtypes.get(c, self.dtypes.get(None, 'auto'))
+                counters[c] = _convert_counter(counters[c], policy)
+                self.curscan['dtypes'][c] = counters[c].typecode
+        if self.__active != None:
+            self.curscan['summary'] = self.summary()
+        if self.__hash != None:
+            self.curscan['hash'] = self.__end_hash()
+        if self.__datahash != None:
+            self.curscan['data_hash'] = self.__datahash.hexdigest()
+            self.__datahash = None
+
+
+    def __end_scan(self):
+        self.__close_scan()
+        self.state = self.between_scans
+        raise(ScanEnd)
+
+
+    def __read_mca(self):
+        """Read an MCA spectrum starting from the current @A line."""
+        cl = self.__curline
+        start = self.lineno
+        parts = cl.split(None, 1)[1:]
+        self.__datahash.update(cl + '\n')
+        try:
+            while cl.endswith('\\'):
+                cl = self.__getline()
+                self.__datahash.update(cl + '\n')
+                parts.append(cl)
+        except InputTimeout:
+            logging.warning('Incomplete MCA spectrum at line %d' % self.lineno)
+            raise
+        if self.mcamode == 'index':
+            self.__mcapending.append(start)
+        elif self.mcamode != 'skip':
+            text = ' '.join(parts).replace('\\', ' ')
+            if self.mcamode == 'array':
+                self.__mcapending.append(decode_mca(text))
+            else:
+                self.__mcapending.append(text)
+        self.__getline()
+
+
+    def __add_mca(self):
+        """Attach the spectra read so far to the last point."""
+        if 'mca' not in self.curscan:
+            self.curscan['mca'] = [ [] for i in
+                                    range(self.curscan['npoints'] - 1) ]
+        self.curscan['mca'].append(self.__mcapending)
+        self.__mcapending = []
+
+
     def __parse_motornames(self):
         cl = self.__curline
         n = 0
-        motorlist = []
+        rawlines = []
         while True:
             m = re.match('^#([A-Z]+[A-Z0-9]*) *(.*[^\W]).*$', cl)
             if m == None:
@@ -179,11 +700,10 @@ class Specparser:
             ltype, lval = m.group(1,2)
             if ltype != ('O%d' % n):
                 break
-            # Motor names are separated by two spaces
-            motorlist.extend(re.split(r'  +', lval))
+            rawlines.append(lval)
             cl = self.__getline()
             n = n+1
-        return motorlist
+        return _split_motornames(rawlines)
 
 
     def __parse_motorpositions(self):
@@ -242,6 +762,7 @@ class Specparser:
         #On     motornames      List of motorname strings.
         #C      comments        List of [lineno, commentline] lists.
         #x      unknown_headers List of [lineno, linestring] lists.
+        N/A     hash            String, MD5 hex digest of the header lines.
         ======  =============== =====
 
         If the complete header is not written to the spec-file after waiting
@@ -260,8 +781,9 @@ class Specparser:
             except InputTimeout:
                 logging.warning('InputTimeout before header')
                 return hdict
+        self.__start_hash()
         while True:
-            m = re.match('^#([A-Z]+[0-9]*) (.*)$', cl)
+            m = re.match('^#(@?[A-Z]+[0-9]*) (.*)$', cl)
             if m == None:
                 break
             ltype, lval = m.group(1,2)
@@ -275,7 +797,7 @@ class Specparser:
                 # Date in datetime format for proper yaml serialization
                 # FIXME: Find out timezone info by comparing epoch and  date?
                 hdict['date'] = datetime.datetime.fromtimestamp(\
-                    time.mktime(time.strptime(lval)))
+                    parse_date(lval))
             elif ltype == 'O0':
                 hdict['motornames'] = self.__parse_motornames()
                 cl = self.__curline
@@ -291,6 +813,7 @@ class Specparser:
                 cl = self.__getline()
             except InputTimeout:
                 cl = ''
+        hdict['hash'] = self.__end_hash()
         if not is_blankline(cl):
             logging.warning("Garbage after header: %s" % cl)
         self.curheader.update(hdict)
@@ -328,31 +851,58 @@ class Specparser:
 
         The keys corresponding to spec-file header lines are
 
-        ======  =============== =====
-        SPEC    key             value
-        ======  =============== =====
-        #S      number          Integer, the scan number.
-        #S      command         String, the command which started the scan.
-        #D      date            Date in :mod:`datetime` format.
-        #T      time            Float, time per scan point.
-        #T      time_units      String, units of time.
-        #M      monitor         Float, monitor counts per scan point.
-        #M      monitor_units   String, units of monitor counts.
-        N/A     counting-to     Either 'time' or 'monitor' depending on
-                                which was used to end counting.
-        #Gn     fourc           List of four lists giving four-circle values.
-        #Q      hklstart        List of HKL coords at the start of the scan.
-        #Pn     motors          A dictionary giving motor positions at
-                                the start of the scan.
-        #N      ncols           Integer, number of counter columns.
-        #L      columns         Names of the columns in the scan.
-        #x      unknown_headers List of [lineno, linestring] headers which
-                                were not recognized.
-        N/A     npoints         Number of points in the scan (so far).
-        N/A     counters        Dictionary with counter names as keys,
-                                lists of counter values at each point as values.
-        #C      comments        List of [lineno, commentline, pointno] lists.
-        ======  =============== =====
+        =======  =============== =====
+        SPEC     key             value
+        =======  =============== =====
+        #S       number          Integer, the scan number.
+        #S       command         String, the command which started the scan.
+        #D       date            Date in :mod:`datetime` format.
+        #T       time            Float, time per scan point.
+        #T       time_units      String, units of time.
+        #M       monitor         Float, monitor counts per scan point.
+        #M       monitor_units   String, units of monitor counts.
+        N/A      counting-to     Either 'time' or 'monitor' depending on
+                                 which was used to end counting.
+        #Gn      fourc           List of four lists giving four-circle values.
+        #Q       hklstart        List of HKL coords at the start of the scan.
+        #Pn      motors          A dictionary giving motor positions at
+                                 the start of the scan.
+        #N       ncols           Integer, number of counter columns.
+        #L       columns         Names of the columns in the scan.
+        #x       unknown_headers List of [lineno, linestring] headers which
+                                 were not recognized.
+        N/A      npoints         Number of points in the scan (so far).
+        N/A      counters        Dictionary with counter names as keys,
+                                 lists of counter values at each point as values.
+                                 Arrays instead of lists, if :attr:`dtypes`
+                                 is set.
+        N/A      dtypes          Dictionary of array typecodes of counters,
+                                 present only if :attr:`dtypes` is set.
+        #@MCA    mca_format      String, format of the MCA data lines.
+        #@CHANN  mca_channels    List of ints: number of MCA channels,
+                                 first and last channel and reduction.
+        #@CALIB  mca_calib       List of MCA calibration coefficients.
+        #@CTIME  mca_ctime       List of MCA preset, live and real times.
+        @A       mca             List with an item for each point, which
+                                 is a list of MCA spectra (see
+                                 :attr:`mcamode`) read before the point.
+                                 Present only if the scan has spectra.
+        @A       mca_unpaired    List of MCA spectra after the last point
+                                 of the scan, present only if there are
+                                 such spectra.
+        N/A      summary         Dictionary of accumulator values, present
+                                 only if :attr:`accumulators` is set.
+        N/A      hash            String, MD5 hex digest of the lines of
+                                 the scan, from #S to the last point or
+                                 comment. Set when the end of the scan
+                                 is read.
+        N/A      data_hash       String, MD5 hex digest of the point and
+                                 @A lines of the scan only. Unlike 'hash',
+                                 it is the same for repeated scans with
+                                 identical data, but different scan
+                                 number, date or comments.
+        #C       comments        List of [lineno, commentline, pointno] lists.
+        =======  =============== =====
 
         """
         cl = self.__curline
@@ -364,13 +914,16 @@ class Specparser:
                     logging.warning('Garbage before scan header: %s' % cl)
             cl = self.__getline()
         self.state = self.in_scan_header
+        self.__start_hash()
+        self.__datahash = hashlib.md5()
         logging.debug("Parsing scan header")
         sdict = {}
         sdict['npoints'] = 0
         sdict['comments'] = []
         sdict['unknown_headers'] = []
+        self.__mcapending = []
         while True:
-            m = re.match('^#([A-Z]+[0-9]*) (.*)$', cl)
+            m = re.match('^#(@?[A-Z]+[0-9]*) (.*)$', cl)
             if m == None:
                 break
             ltype, lval = m.group(1,2)
@@ -385,7 +938,7 @@ class Specparser:
             elif ltype == 'D':
                 # Date in datetime format for proper yaml serialization
                 sdict['date'] = datetime.datetime.fromtimestamp(\
-                    time.mktime(time.strptime(lval)))
+                    parse_date(lval))
             elif ltype == 'T':
                 # Counting to time, n sec. per point
                 sdict['counting-to'] = 'time'
@@ -418,6 +971,18 @@ class Specparser:
                 # Motor names in the scan
                 lclean = re.search('\W*(.*[^\W]+).*', lval).group(1)
                 sdict['columns'] = re.split('  +', lclean)
+            elif ltype == '@MCA':
+                # MCA data format
+                sdict['mca_format'] = lval.strip()
+            elif ltype == '@CHANN':
+                # Number of MCA channels, first, last and reduction
+                sdict['mca_channels'] = map(int, lval.split())
+            elif ltype == '@CALIB':
+                # MCA energy calibration coefficients
+                sdict['mca_calib'] = map(float, lval.split())
+            elif ltype == '@CTIME':
+                # MCA preset, live and real time
+                sdict['mca_ctime'] = map(float, lval.split())
             elif ltype == 'C':
                 # Comments before the first scan point
                 sdict['comments'].append([self.lineno, cl, sdict['npoints']-1])
@@ -426,10 +991,21 @@ class Specparser:
                 logging.info('Unknown scan header: %s' % cl)
                 sdict['unknown_headers'].append([self.lineno, cl])
             cl = self.__getline()
+        if self.dtypes != None:
+            _check_dtypes(self.dtypes)
         counters = {}
         for c in sdict['columns']:
-            counters[c] = []
+            if self.dtypes == None:
+                counters[c] = []
+            else:
+                counters[c] = array.array('d')
         sdict['counters'] = counters
+        if self.accumulators == None:
+            self.__active = None
+        else:
+            self.__active = [ (k, a) for k, a in self.accumulators.items()
+                                if a.reset(sdict['columns']) ]
+            sdict['summary'] = {}
         self.curscan = sdict
         self.state = self.in_scan
         return sdict
@@ -443,8 +1019,7 @@ class Specparser:
         cl = self.__curline
         while True:
             if is_blankline(cl):
-                self.state = self.between_scans
-                raise(ScanEnd)
+                self.__end_scan()
             try:
                 pts = map(float, cl.split())
                 if len(pts) != self.curscan['ncols']:
@@ -454,11 +1029,24 @@ class Specparser:
                     self.state = self.in_scan
                     self.lastpoint = pts
                     self.curscan['npoints'] += 1
-                    for ctr, val in zip(self.curscan['columns'], pts):
-                        self.curscan['counters'][ctr].append(val)
+                    self.__datahash.update(cl + '\n')
+                    if self.__mcapending or 'mca' in self.curscan:
+                        self.__add_mca()
+                    if self.__active == None:
+                        for ctr, val in zip(self.curscan['columns'], pts):
+                            self.curscan['counters'][ctr].append(val)
+                    else:
+                        for k, a in self.__active:
+                            a.update(pts)
                     cl = self.__getline()
                     break # Got our line
             except ValueError:
+                if cl[:2] == '@A':
+                    # MCA spectrum of the next point
+                    self.state = self.in_scan
+                    self.__read_mca()
+                    cl = self.__curline
+                    continue
                 m = re.match('^#([A-Z]+[0-9]*) (.*)$', cl)
                 if m == None:
                     logging.error("Bad line in scan")
@@ -471,12 +1059,28 @@ class Specparser:
                     cl = self.__getline()
                 else:
                     # Control line other than a comment ends the scan
-                    self.state = self.between_scans
-                    raise(ScanEnd)
+                    self.__end_scan()
 
         return pts
 
 
+    def summary(self):
+        """Return a dictionary with the values of :attr:`accumulators`
+        for the points of the current scan read so far.
+
+        Accumulators which do not apply to the current scan, because
+        it lacks the required columns, have the value None. Returns an
+        empty dictionary if :attr:`accumulators` is not set.
+        """
+        if self.accumulators == None:
+            return {}
+        sdict = dict.fromkeys(self.accumulators.keys())
+        if self.__active != None:
+            for k, a in self.__active:
+                sdict[k] = a.value()
+        return sdict
+
+
     def parse(self):
         """Return a dictionary of scans parsed from a specfile.
 
@@ -487,28 +1091,505 @@ class Specparser:
         Additionally, the return value has a 'headers' attribute
         containing a list of (scannumber, headerdict) tuples. Here
         scannumber is the number of scan before which the information in
-        headerdict was read. See :meth:`header`.
+        headerdict was read. See :meth:`header`. The 'order' attribute
+        contains a list of (number, index) keys of the scans in the order
+        they appear in the file.
 
         This function will return after waiting :attr:`timeout` seconds,
         so not all the scans may be returned.
         """
         scans = ScanDict()
+        order = []
         lastscanno = 0
         try:
             self.header()
             while True:
                 s = self.next_scan()
                 scans[s['number']] = s
+                order.append((s['number'], len(scans.getraw(s['number']))-1))
                 lastscanno = s['number']
         except InputTimeout:
             if self.state == self.in_scan and (len(scans) <= 1 \
                 or lastscanno == self.curscan['number']-1):
                 # Add the last, possibly incomplete scan
-                scans[self.curscan['number']] = self.curscan
+                self.__close_scan()
+                number = self.curscan['number']
+                scans[number] = self.curscan
+                order.append((number, len(scans.getraw(number))-1))
             elif len(scans) > 1 \
                 and lastscanno != self.curscan['number']:
                 raise ParseError()
         self.state = self.done
         scans.headers = self.headers
+        scans.order = order
         return scans
 
+
+
+
+def _scan_nbytes(scan):
+    """Return a rough estimate of the memory used by a scan dictionary."""
+    n = 2048 + 100*len(scan.get('motors', {}))
+    for vals in scan['counters'].values():
+        if isinstance(vals, array.array):
+            n += vals.itemsize*len(vals)
+        else:
+            # Float object and list pointer
+            n += 32*len(vals)
+    for spectra in scan.get('mca', []):
+        for spc in spectra:
+            if isinstance(spc, array.array):
+                n += spc.itemsize*len(spc)
+            elif isinstance(spc, str):
+                n += len(spc)
+            else:
+                # Line number
+                n += 32
+    return n
+
+
+class _PendingParse(object):
+    """Parse of a file in progress in :class:`ScanCache`, which other
+    threads can wait for."""
+    def __init__(self, version):
+        self.version = version
+        self.done = threading.Event()
+        self.scans = None
+        self.error = None
+
+
+class ScanCache(object):
+    """Thread-safe cache of parsed scans with LRU eviction.
+
+    Scans are retrieved with :meth:`get`. When a scan is not in the cache,
+    its file is parsed and all the scans in the file are added to the
+    cache. Threads which miss the cache while the same file is being
+    parsed wait for that parse instead of parsing the file again. Least
+    recently used scans are evicted when the estimated memory use of the
+    cached scans exceeds `maxbytes`.
+
+    Files are identified by their absolute path. The cached scans of a
+    file are discarded when the device, inode, size or modification time
+    of the file changes.
+
+    The returned scan dictionaries are shared between callers and
+    should not be modified.
+
+    Instance variables:
+
+    :attr:`hits`, :attr:`misses`, :attr:`evictions`
+        Number of cache hits, misses and evicted scans.
+
+    :attr:`parses`
+        Number of files parsed.
+
+    :attr:`nbytes`
+        Estimated memory use of the cached scans.
+    """
+    def __init__(self, maxbytes=256*1024*1024):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parses = 0
+        self.__lock = threading.Lock()
+        # (path, number, repeat) -> (scan, nbytes), in LRU order
+        self.__entries = collections.OrderedDict()
+        # path -> (file version, set of keys in __entries)
+        self.__files = {}
+        # path -> _PendingParse of the file
+        self.__pending = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __remove(self, key):
+        scan, nbytes = self.__entries.pop(key)
+        self.nbytes -= nbytes
+        self.__files[key[0]][1].discard(key)
+
+    def __invalidate(self, path):
+        if path in self.__files:
+            for key in list(self.__files[path][1]):
+                self.__remove(key)
+            del self.__files[path]
+
+    def __insert(self, key, scan):
+        if key in self.__entries:
+            self.__remove(key)
+        nbytes = _scan_nbytes(scan)
+        self.__entries[key] = (scan, nbytes)
+        self.__files[key[0]][1].add(key)
+        self.nbytes += nbytes
+
+    def __evict(self):
+        while self.nbytes > self.maxbytes and self.__entries:
+            key = iter(self.__entries).next()
+            self.__remove(key)
+            self.evictions += 1
+
+    def get(self, path, number, repeat=0):
+        """Return a scan with a given number and repeat index from a
+        spec-file in `path` (see :meth:`ScanDict.__getitem__`).
+
+        Raises KeyError if the file does not contain the scan.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        version = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        key = (path, number, repeat)
+        with self.__lock:
+            if path in self.__files and self.__files[path][0] != version:
+                self.__invalidate(path)
+            if key in self.__entries:
+                self.hits += 1
+                # Move to the most recently used end
+                entry = self.__entries.pop(key)
+                self.__entries[key] = entry
+                return entry[0]
+            self.misses += 1
+            pending = self.__pending.get(path)
+            parsing = pending == None or pending.version != version
+            if parsing:
+                pending = _PendingParse(version)
+                self.__pending[path] = pending
+                self.parses += 1
+        if parsing:
+            self.__parse(path, pending, key)
+        else:
+            pending.done.wait()
+        if pending.error != None:
+            raise pending.error
+        try:
+            return pending.scans[number, repeat]
+        except (KeyError, IndexError):
+            raise KeyError((number, repeat))
+
+    def __parse(self, path, pending, key):
+        """Parse a file, add its scans to the cache and wake up the
+        threads waiting for `pending`. The scan with `key` is added last,
+        so that it is evicted last."""
+        try:
+            fid = open(path)
+            try:
+                pending.scans = Specparser(fid).parse()
+            finally:
+                fid.close()
+        except Exception as e:
+            pending.error = e
+        with self.__lock:
+            if self.__pending.get(path) is pending:
+                del self.__pending[path]
+            if pending.error == None:
+                self.__invalidate(path)
+                self.__files[path] = (pending.version, set())
+                for (n, i), scan in pending.scans.items():
+                    if (path, n, i) != key:
+                        self.__insert((path, n, i), scan)
+                if key[1:] in pending.scans.keys():
+                    self.__insert(key, pending.scans[key[1:]])
+                self.__evict()
+        pending.done.set()
+
+    def clear(self):
+        """Remove all scans from the cache."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__files.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return a dictionary with the cache statistics."""
+        with self.__lock:
+            return { 'hits' : self.hits, 'misses' : self.misses,
+                     'evictions' : self.evictions, 'parses' : self.parses,
+                     'entries' : len(self.__entries),
+                     'nbytes' : self.nbytes, 'maxbytes' : self.maxbytes }
+
+
+class SharedArray(object):
+    """Read-only sequence of floats in a shared memory block.
+
+    Items are read from the block when accessed, the data is not copied
+    when the array is created. The underlying memory can be accessed
+    without copying with :meth:`buffer`, e.g. for numpy.frombuffer().
+    """
+    def __init__(self, mm, offset, length):
+        self.__mm = mm
+        self.__offset = offset
+        self.__len = length
+
+    def __len__(self):
+        return self.__len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.__len)
+            if step == 1:
+                return list(struct.unpack_from('%dd' % max(stop - start, 0),
+                    self.__mm, self.__offset + 8*start))
+            return [ self[j] for j in xrange(start, stop, step) ]
+        if i < 0:
+            i = i + self.__len
+        if i < 0 or i >= self.__len:
+            raise IndexError('SharedArray index out of range')
+        return struct.unpack_from('d', self.__mm, self.__offset + 8*i)[0]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'SharedArray(%s)' % repr(self.tolist())
+
+    def tolist(self):
+        """Return a list with a copy of the values."""
+        return self[:]
+
+    def buffer(self):
+        """Return a read-only buffer of the values as native doubles."""
+        return buffer(self.__mm, self.__offset, 8*self.__len)
+
+
+# Numeric scan keys which are stored in a shared memory block
+_SHARED_KEYS = ('counters', 'motors', 'fourc', 'hklstart', 'mca')
+
+class SharedScans(object):
+    """Picklable descriptor of parsed scans in a shared memory block.
+
+    Created with :func:`export_shared`. The numeric data of the scans
+    (counters, motor positions, four-circle parameters, HKL coordinates
+    and MCA spectra) are stored in a block which is a file in a
+    memory-backed file system (/dev/shm, if available). The descriptor
+    contains only the other scan header values and the locations of
+    the data in the block, and can be passed cheaply to other processes.
+
+    The block exists until :meth:`unlink` is called, or the
+    descriptor is used as a context manager and the with-block exits.
+    Scans which have been attached with :meth:`attach` stay readable
+    after the block is unlinked, until they are detached.
+    """
+    def __init__(self, path, entries, headers, order):
+        self.path = path
+        self.entries = entries
+        self.headers = headers
+        self.order = order
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+    def attach(self):
+        """Return a :class:`ScanDict` with scans whose counters and MCA
+        spectra are read-only :class:`SharedArray` views to the block.
+
+        Motor positions, four-circle parameters and HKL coordinates are
+        copied from the block to ordinary dicts and lists. Counters are
+        stored as doubles, which is reflected in the 'dtypes' dictionary
+        of the scans.
+        """
+        fid = open(self.path, 'rb')
+        try:
+            mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fid.close()
+        def view(loc):
+            return SharedArray(mm, 8*loc[0], loc[1])
+        scans = ScanDict()
+        for number, meta, fields in self.entries:
+            scan = dict(meta)
+            scan['counters'] = dict([ (c, view(loc)) for c, loc
+                                      in fields['counters'].items() ])
+            if 'motors' in fields:
+                names, loc = fields['motors']
+                scan['motors'] = dict(zip(names, view(loc).tolist()))
+            if 'fourc' in fields:
+                scan['fourc'] = [ view(loc).tolist()
+                                  for loc in fields['fourc'] ]
+            if 'hklstart' in fields:
+                scan['hklstart'] = view(fields['hklstart']).tolist()
+            if 'mca' in fields:
+                scan['mca'] = [ [ view(loc) for loc in spectra ]
+                                for spectra in fields['mca'] ]
+            scans[number] = scan
+        scans.headers = self.headers
+        scans.order = self.order
+        scans.shm = mm
+        return scans
+
+    def detach(self, scans):
+        """Release the shared memory of scans returned by :meth:`attach`.
+
+        The views in `scans` can not be used after this.
+        """
+        scans.shm.close()
+
+    def unlink(self):
+        """Remove the shared memory block."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def export_shared(scans, dirname=None):
+    """Store the numeric data of parsed scans in a shared memory block.
+
+    `scans` is a :class:`ScanDict` as returned by :meth:`Specparser.parse`.
+    The block is created in `dirname`, by default in /dev/shm or, if
+    that does not exist, in the default temporary directory.
+
+    Returns a :class:`SharedScans` descriptor. The caller is responsible
+    for removing the block with :meth:`SharedScans.unlink`.
+    """
+    data = array.array('d')
+    def put(vals):
+        if isinstance(vals, str):
+            vals = decode_mca(vals)
+        elif isinstance(vals, array.array) and vals.typecode != 'd':
+            vals = vals.tolist()
+        loc = (len(data), len(vals))
+        data.extend(vals)
+        return loc
+    entries = []
+    for (number, i), scan in scans.items():
+        meta = dict([ (k, v) for k, v in scan.items()
+                      if k not in _SHARED_KEYS ])
+        if 'dtypes' in meta:
+            # All counters are stored as doubles in the block
+            meta['dtypes'] = dict.fromkeys(meta['dtypes'], 'd')
+        fields = {}
+        fields['counters'] = dict([ (c, put(v)) for c, v
+                                    in scan['counters'].items() ])
+        if 'motors' in scan:
+            names = scan['motors'].keys()
+            fields['motors'] = (names,
+                                put([ scan['motors'][m] for m in names ]))
+        if 'fourc' in scan:
+            fields['fourc'] = [ put(l) for l in scan['fourc'] ]
+        if 'hklstart' in scan:
+            fields['hklstart'] = put(scan['hklstart'])
+        if 'mca' in scan and any([ isinstance(spc, (int, long))
+                for spectra in scan['mca'] for spc in spectra ]):
+            # Line numbers of spectra are not numeric data
+            meta['mca'] = scan['mca']
+        elif 'mca' in scan:
+            fields['mca'] = [ [ put(spc) for spc in spectra ]
+                              for spectra in scan['mca'] ]
+        entries.append((number, meta, fields))
+    if len(data) == 0:
+        # Empty files can not be mapped
+        data.append(0.0)
+    if dirname == None:
+        dirname = '/dev/shm' if os.path.isdir('/dev/shm') \
+            else tempfile.gettempdir()
+    fd, path = tempfile.mkstemp(prefix='specparser-', suffix='.shm',
+                                dir=dirname)
+    fout = os.fdopen(fd, 'wb')
+    try:
+        data.tofile(fout)
+    finally:
+        fout.close()
+    return SharedScans(path, entries, getattr(scans, 'headers', []),
+                       getattr(scans, 'order', None))
+
+
+class TimeIndex(object):
+    """Index of scans by their start time (#D line), for fast queries
+    of scans started within a given time window.
+
+    Created from a :class:`ScanDict` returned by :meth:`Specparser.parse`.
+    The start times are stored as seconds since epoch in local time.
+    Scan times usually increase monotonically in a file, so the scans
+    are found with binary searches. If the clock has been set backwards
+    during the file, the scans are split into runs of non-decreasing
+    times, which are searched separately.
+
+    Scan dictionaries which do not have the 'order' attribute of
+    :meth:`Specparser.parse` results, e.g. unpickled from older files,
+    are assumed to be in the file order of repeat indices and then
+    scan numbers.
+    """
+    def __init__(self, scans):
+        # List of (epochs, keys) pairs of runs in file order
+        self.runs = []
+        prev = None
+        order = getattr(scans, 'order', None)
+        if order == None:
+            # Scans not from parse(), e.g. unpickled from old files
+            order = sorted(scans.keys(), key=lambda k: (k[1], k[0]))
+        for key in order:
+            date = scans[key].get('date')
+            if date == None:
+                continue
+            epoch = _hour_epoch(date.year, date.month, date.day, date.hour) \
+                + 60*date.minute + date.second
+            if prev == None or epoch < prev:
+                self.runs.append(([], []))
+            self.runs[-1][0].append(epoch)
+            self.runs[-1][1].append(key)
+            prev = epoch
+
+    def scans_between(self, t0, t1):
+        """Return a list of (number, index) keys of scans started at or
+        after `t0` and at or before `t1`, in file order.
+
+        The times can be either seconds since epoch or
+        :class:`datetime.datetime` instances in local time.
+        """
+        if isinstance(t0, datetime.datetime):
+            t0 = time.mktime(t0.timetuple()) + t0.microsecond*1e-6
+        if isinstance(t1, datetime.datetime):
+            t1 = time.mktime(t1.timetuple()) + t1.microsecond*1e-6
+        keys = []
+        for epochs, rkeys in self.runs:
+            start = bisect.bisect_left(epochs, t0)
+            end = bisect.bisect_right(epochs, t1)
+            keys.extend(rkeys[start:end])
+        return keys
+
+def _load_one(path):
+    """Parse a single file for :func:`load_many`"""
+    try:
+        fid = open(path)
+        try:
+            return Specparser(fid).parse()
+        finally:
+            fid.close()
+    except Exception as e:
+        return LoadError(path, e)
+
+
+def load_many(paths, workers=4, processes=False):
+    """Parse several complete spec-files concurrently.
+
+    Files are parsed with a pool of `workers` threads, which overlaps the
+    file I/O of different files. If `processes` is True, a pool of worker
+    processes is used instead, which is faster when parsing is CPU-bound.
+    Motor name tables (#On lines) are parsed only once for each distinct
+    header, see :func:`_split_motornames`.
+
+    Returns a list of scan dictionaries (see :meth:`Specparser.parse`)
+    in the same order as `paths`. Files which could not be read or
+    parsed are represented by a :class:`LoadError` instance in the list,
+    the rest of the batch is loaded normally.
+    """
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        return map(_load_one, paths)
+    if processes:
+        from multiprocessing import Pool
+    else:
+        from multiprocessing.pool import ThreadPool as Pool
+    pool = Pool(min(workers, len(paths)))
+    try:
+        return pool.map(_load_one, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
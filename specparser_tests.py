@@ -118,3 +118,669 @@ def comment_end_test():
     nonnil_t(scans)
     scanheader_t(scans)
 
+
+
+def load_many_test():
+    fnames = ['mini.spec', 'nonexistent.spec', 'simple.spec', 'oneline.spec']
+    paths = [ datadir + f for f in fnames ]
+    for procs in (False, True):
+        res = sp.load_many(paths, workers=3, processes=procs)
+        assert(len(res) == len(paths))
+        assert(isinstance(res[1], sp.LoadError))
+        assert(res[1].path == paths[1])
+        for path, scans in zip(paths[::2] + [paths[3]], res[::2] + [res[3]]):
+            with open(path) as fid:
+                assert(scans == sp.Specparser(fid).parse())
+    # Motor name lists are shared between files, but not between results
+    res = sp.load_many([datadir + 'mini.spec'] * 2, workers=2)
+    mn0 = res[0].headers[0][1]['motornames']
+    mn1 = res[1].headers[0][1]['motornames']
+    assert(mn0 == mn1 and mn0 is not mn1)
+
+
+def pickle_roundtrip_test():
+    import pickle
+    with open(datadir + 'mini.spec') as fid:
+        scans = sp.Specparser(fid).parse()
+    for proto in (0, 2):
+        pscns = pickle.loads(pickle.dumps(scans, proto))
+        assert(pscns == scans)
+        assert(pscns.headers == scans.headers)
+
+
+def accumulator_test():
+    with open(datadir + 'simple.spec') as fid:
+        full = sp.Specparser(fid).parse()
+    with open(datadir + 'simple.spec') as fid:
+        p = sp.Specparser(fid)
+        p.accumulators = {
+            'sum' : sp.Sum('Detector'),
+            'normsum' : sp.Sum('Detector', norm='Seconds'),
+            'min' : sp.Min('Detector'),
+            'max' : sp.Max('Detector'),
+            'argmax' : sp.ArgMax('Detector'),
+            'mean' : sp.Mean('Detector'),
+            'centroid' : sp.Centroid('Detector'),
+            'fwhm' : sp.FWHM('Detector'),
+            'missing' : sp.Sum('No such counter'),
+        }
+        scans = p.parse()
+    assert(len(scans) == len(full))
+    for k in full.keys():
+        s, fs = scans[k], full[k]
+        assert(s['npoints'] == fs['npoints'])
+        assert(all(v == [] for v in s['counters'].values()))
+        summ = s['summary']
+        det = fs['counters']['Detector']
+        x = fs['counters'][fs['columns'][0]]
+        assert(summ['missing'] == None)
+        assert(summ['sum'] == sum(det))
+        assert(summ['normsum'] == sum(d/t for d, t in
+                                   zip(det, fs['counters']['Seconds'])))
+        assert(summ['min'] == min(det))
+        assert(summ['max'] == max(det))
+        assert(summ['argmax'] == x[det.index(max(det))])
+        assert(abs(summ['mean'] - sum(det)/len(det)) < 1e-9)
+        if sum(det) != 0.0:
+            c = sum(xx*d for xx, d in zip(x, det)) / sum(det)
+            assert(abs(summ['centroid'] - c) < 1e-9)
+            assert(summ['fwhm'] >= 0.0)
+
+
+def specserver_test():
+    import os, tempfile, shutil, specserver
+    def wait_for(cond):
+        t0 = time.time()
+        while not cond():
+            assert(time.time() - t0 < 10.0)
+            time.sleep(0.01)
+    with open(datadir + 'oneline.spec') as fid:
+        lines = fid.readlines()
+    scanhead = [ l for l in lines if l.startswith('#') ][5:]
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    out = None
+    clients = []
+    def subscribe(path):
+        msgs = specserver.subscribe(server.address, path)
+        clients.append(msgs)
+        return msgs
+    try:
+        specfile = os.path.join(tmpdir, 'live.spec')
+        out = open(specfile, 'w')
+        out.writelines(lines + ['\n'])
+        out.flush()
+        server = specserver.SpecServer(os.path.join(tmpdir, 'sock'),
+                                       [specfile], maxqueue=5)
+        server.start()
+        follower = server.followers[specfile]
+        wait_for(lambda: follower.scan != None and follower.points)
+        msgs = subscribe(specfile)
+        snap = msgs.next()
+        assert(snap['type'] == 'snapshot')
+        assert(snap['header']['epoch'] == 974979799)
+        assert(snap['scan']['number'] == 1)
+        assert(len(snap['points']) == 1)
+        # New scan with a comment
+        out.writelines([ l.replace('#S 1', '#S 2') for l in scanhead ])
+        out.write('0.1 0 0 7 1 0 0 0 1\n#C a comment\n')
+        out.write('0.2 0 0 8 1 0 0 0 3\n\n')
+        out.flush()
+        types = []
+        while True:
+            m = msgs.next()
+            types.append(m['type'])
+            if m['type'] == 'end':
+                break
+        assert(types == ['scan', 'point', 'comment', 'point', 'end'])
+        assert(m['number'] == 2 and m['npoints'] == 2)
+        # Late joiner gets the current scan
+        snap = subscribe(specfile).next()
+        assert(snap['scan']['number'] == 2)
+        assert(snap['scan']['comments'][0][1] == '#C a comment')
+        assert(snap['points'][1] == [0.2, 0, 0, 8, 1, 0, 0, 0, 3])
+        # Slow subscriber is resynchronized with a snapshot
+        sub = follower.subscribe()
+        out.writelines([ l.replace('#S 1', '#S 3') for l in scanhead ])
+        out.writelines([ '%d 0 0 0 1 0 0 0 1\n' % i for i in range(20) ])
+        out.write('\n')
+        out.flush()
+        wait_for(lambda: follower.scan['number'] == 3
+                         and len(follower.points) == 20)
+        wait_for(lambda: sub.queue.queue[-1]['type'] == 'end')
+        queued = list(sub.queue.queue)
+        assert(len(queued) <= 5)
+        assert(queued[0]['type'] == 'snapshot')
+        assert(queued[0]['scan']['number'] == 3)
+        # The snapshot and the points after it cover the whole scan
+        points = queued[0]['points'] + [ m['point'] for m in queued[1:-1] ]
+        assert(points == [ [i, 0, 0, 0, 1, 0, 0, 0, 1] for i in range(20) ])
+        # End and error messages are kept when the queue overflows
+        sub = follower.subscribe()
+        out.writelines([ l.replace('#S 1', '#S 4') for l in scanhead ])
+        # Queue is full again after the 8th point, when the error comes
+        out.writelines([ '%d 0 0 0 1 0 0 0 1\n' % i for i in range(8) ])
+        out.write('garbage\n')
+        out.flush()
+        follower.join(10.0)
+        assert(not follower.is_alive())
+        queued = list(sub.queue.queue)
+        assert([ m['type'] for m in queued ] == ['snapshot', 'error'])
+        assert(queued[0]['scan']['number'] == 4)
+        assert(sub not in follower.subscribers)
+        # Unknown and unreadable files
+        unknown = subscribe('nonexistent').next()
+        assert(unknown['type'] == 'error')
+        missing = os.path.join(tmpdir, 'missing.spec')
+        server.add_file(missing)
+        server.followers[missing].join(10.0)
+        msgs = subscribe(missing)
+        assert(msgs.next()['type'] == 'snapshot')
+        assert(msgs.next()['type'] == 'error')
+    finally:
+        for msgs in clients:
+            msgs.close()
+        if server != None:
+            server.stop()
+        if out != None:
+            out.close()
+        shutil.rmtree(tmpdir)
+
+
+def hash_test():
+    import hashlib, StringIO
+    with open(datadir + 'oneline.spec') as fid:
+        text = fid.read()
+    header, scan = text.split('\n\n')
+    # Same scan repeated with a different scan before it
+    other = scan.replace('-0.8 -0.00558988', '-0.7 -0.00558988')
+    spec = header + '\n\n' + scan + '\n' + other + '\n' + scan
+    p = sp.Specparser(StringIO.StringIO(spec))
+    scans = p.parse()
+    assert(scans.headers[0][1]['hash'] == \
+        hashlib.md5(header + '\n').hexdigest())
+    assert(scans[1, 0]['hash'] == hashlib.md5(scan).hexdigest())
+    assert(scans[1, 0]['hash'] == scans[1, 2]['hash'])
+    assert(scans[1, 0]['hash'] != scans[1, 1]['hash'])
+    # Repeated scans differ in number and date, only their data is equal
+    point = scan.rsplit('\n', 2)[1]
+    repeat = scan.replace('#S 1 ', '#S 3 ').replace('13:43:23', '14:00:00')
+    spectrum = '@A 1 2\\\n 3\n'
+    spec = header + '\n\n' + scan + '\n' + other + '\n' + repeat + '\n' \
+        + repeat.replace('#S 3 ', '#S 4 ').replace(point, '#C moved\n'
+            + point) + '\n' + repeat.replace('#S 3 ', '#S 5 ') \
+            .replace(point, spectrum + point)
+    scans = sp.Specparser(StringIO.StringIO(spec)).parse()
+    assert(scans[1, 0]['hash'] != scans[3]['hash'])
+    assert(scans[1, 0]['data_hash'] == scans[3]['data_hash'])
+    assert(scans[1, 0]['data_hash'] == scans[4]['data_hash'])
+    assert(scans[1, 0]['data_hash'] != scans[1, 1]['data_hash'])
+    assert(scans[1, 0]['data_hash'] != scans[5]['data_hash'])
+    assert(scans[1, 0]['data_hash'] == \
+        hashlib.md5(point + '\n').hexdigest())
+    # Hash of a scan ending in a comment and a scan without blank line
+    with open(datadir + 'endcomment.spec') as fid:
+        p = sp.Specparser(fid)
+        scans = p.parse()
+    with open(datadir + 'endcomment.spec') as fid:
+        text = fid.read()
+    for s in scans.values():
+        start = text.index('#S %d ' % s['number'])
+        ends = [ text.find(sep, start) + 1 for sep in ('\n\n', '\n#S') ]
+        end = min([ e for e in ends if e > 0 ] + [len(text)])
+        assert(s['hash'] == hashlib.md5(text[start:end]).hexdigest())
+
+
+def mca_test():
+    import os, tempfile, StringIO
+    with open(datadir + 'oneline.spec') as fid:
+        text = fid.read()
+    header, scan = text.split('\n\n')
+    scanhead, point = scan.rsplit('\n', 2)[:2]
+    scanhead = scanhead.replace('#N 9', '#N 9\n#@MCA 16C\n#@CHANN 20 0 19 1'
+                                         '\n#@CALIB 0 1 0')
+    spectrum = '@A ' + ' '.join(map(str, range(16))) + '\\\n 16 17 18 19\n'
+    spec = header + '\n\n' + scanhead + '\n' + point + '\n' \
+        + spectrum + point + '\n' + spectrum + spectrum + point + '\n'
+    fd, fname = tempfile.mkstemp()
+    os.write(fd, spec)
+    os.close(fd)
+    try:
+        for mode in ('array', 'text', 'index', 'skip'):
+            p = sp.Specparser(StringIO.StringIO(spec))
+            p.mcamode = mode
+            s = p.parse()[1]
+            assert(s['npoints'] == 3)
+            assert(s['mca_format'] == '16C')
+            assert(s['mca_channels'] == [20, 0, 19, 1])
+            assert(s['mca_calib'] == [0.0, 1.0, 0.0])
+            assert(len(s['counters']['Detector']) == 3)
+            if mode == 'skip':
+                assert('mca' not in s)
+                continue
+            assert([ len(l) for l in s['mca'] ] == [0, 1, 2])
+            for spc in s['mca'][1] + s['mca'][2]:
+                if mode == 'text':
+                    spc = sp.decode_mca(spc)
+                elif mode == 'index':
+                    assert(spec.split('\n')[spc].startswith('@A'))
+                    spc = sp.read_mca(fname, spc)
+                assert(list(spc) == range(20))
+        # Line numbers are kept as metadata in shared memory
+        p = sp.Specparser(open(fname))
+        p.mcamode = 'index'
+        scans = p.parse()
+        with sp.export_shared(scans) as desc:
+            shared = desc.attach()
+            assert(shared[1]['mca'] == scans[1]['mca'])
+            desc.detach(shared)
+        try:
+            sp.read_mca(fname, 0)
+            assert(False)
+        except ValueError:
+            pass
+    finally:
+        os.unlink(fname)
+
+
+def scancache_test():
+    import os, tempfile, shutil, threading
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'simple.spec')
+        shutil.copy(datadir + 'simple.spec', path)
+        with open(path) as fid:
+            scans = sp.Specparser(fid).parse()
+        cache = sp.ScanCache()
+        assert(cache.get(path, 2) == scans[2])
+        st = cache.stats()
+        assert(st['misses'] == 1 and st['entries'] == len(scans))
+        assert(cache.get(path, 1) is cache.get(path, 1))
+        assert(cache.stats()['hits'] == 2)
+        try:
+            cache.get(path, 1234)
+            assert(False)
+        except KeyError:
+            pass
+        # Only the most recently used scan fits
+        small = sp.ScanCache(maxbytes=sp._scan_nbytes(scans[2]))
+        small.get(path, 2)
+        st = small.stats()
+        assert(st['entries'] == 1 and st['evictions'] == len(scans) - 1)
+        assert(st['nbytes'] <= st['maxbytes'])
+        small.get(path, 2)
+        assert(small.stats()['hits'] == 1)
+        # Changing the file invalidates its scans
+        with open(path, 'a') as fid:
+            fid.write('\n#S 4  ascan  tth 0 1  1 1\n#N 1\n#L Detector\n1\n')
+        assert(cache.get(path, 4)['counters']['Detector'] == [1.0])
+        assert(cache.stats()['misses'] == 3)
+        # Concurrent access
+        cache.clear()
+        failures = []
+        def worker():
+            try:
+                for i in range(20):
+                    if cache.get(path, 1 + i % 2)['number'] != 1 + i % 2:
+                        failures.append(i)
+            except Exception as e:
+                failures.append(e)
+        threads = [ threading.Thread(target=worker) for i in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert(failures == [])
+        st = cache.stats()
+        assert(st['hits'] + st['misses'] == 5 + 80)
+        # Simultaneous misses wait for a single parse of the file
+        cache.clear()
+        parses = cache.stats()['parses']
+        parser = sp.Specparser
+        class SlowParser(parser):
+            def parse(self):
+                time.sleep(0.2)
+                return parser.parse(self)
+        class FailingParser(parser):
+            def parse(self):
+                time.sleep(0.2)
+                raise sp.ParseError('bad')
+        def read_all(cls):
+            results = []
+            def reader():
+                try:
+                    results.append(cache.get(path, 1))
+                except Exception as e:
+                    results.append(e)
+            sp.Specparser = cls
+            try:
+                threads = [ threading.Thread(target=reader) for i in range(8) ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                sp.Specparser = parser
+            return results
+        results = read_all(SlowParser)
+        assert(len(results) == 8)
+        assert(all(r is results[0] for r in results))
+        assert(results[0]['number'] == 1)
+        assert(cache.stats()['parses'] == parses + 1)
+        # Waiting threads get the error of a failed parse
+        cache.clear()
+        results = read_all(FailingParser)
+        assert(len(results) == 8)
+        assert(all(isinstance(r, sp.ParseError) for r in results))
+        assert(cache.stats()['parses'] == parses + 2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _shared_worker(desc):
+    scans = desc.attach()
+    res = [ (s['number'], sum(s['counters']['Detector']), s['motors'])
+            for s in scans.values() ]
+    desc.detach(scans)
+    return res
+
+
+def shared_test():
+    import os, pickle
+    from multiprocessing import Pool
+    with open(datadir + 'simple.spec') as fid:
+        scans = sp.Specparser(fid).parse()
+    with sp.export_shared(scans) as desc:
+        assert(os.path.exists(desc.path))
+        desc = pickle.loads(pickle.dumps(desc, 2))
+        shared = desc.attach()
+        assert(shared.keys() == scans.keys())
+        for k in scans.keys():
+            s, ss = scans[k], shared[k]
+            for key in s.keys():
+                assert(ss[key] == s[key])
+        det = shared[2]['counters']['Detector']
+        assert(det[-1] == scans[2]['counters']['Detector'][-1])
+        assert(det[3:10:2] == scans[2]['counters']['Detector'][3:10:2])
+        pool = Pool(2)
+        res = pool.map(_shared_worker, [desc, desc])
+        pool.close()
+        pool.join()
+        for r in res:
+            for number, total, motors in r:
+                assert(total == sum(scans[number]['counters']['Detector']))
+                assert(motors == scans[number]['motors'])
+    assert(not os.path.exists(desc.path))
+    # Attached scans remain valid until detached
+    assert(len(det) == 101 and det[0] == scans[2]['counters']['Detector'][0])
+    desc.detach(shared)
+
+
+def date_test():
+    import os
+    tz = os.environ.get('TZ')
+    try:
+        # Dates around the daylight saving time changes in both zones
+        for zone in ('Europe/Zurich', 'America/New_York'):
+            os.environ['TZ'] = zone
+            time.tzset()
+            sp._hour_epochs.clear()
+            for d in ['Thu Feb 25 14:20:14 2010', 'Sun Mar 28 02:30:00 2010',
+                      'Sun Oct 31 02:59:59 2010', 'Mon Feb  1 00:00:00 2010',
+                      'Sun Mar 14 02:30:00 2010', 'Sun Nov  7 01:30:00 2010']:
+                assert(sp.parse_date(d) == time.mktime(time.strptime(d)))
+                assert(sp.parse_date(d) == sp.parse_date(d))
+    finally:
+        if tz == None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+        sp._hour_epochs.clear()
+    for d in ['Tue Feb 30 12:00:00 2010', 'Mon Feb  1 24:00:00 2010',
+              'Mon Feb  1 12:60:00 2010', 'Xyz Foo  1 12:00:00 2010',
+              'Xyz Feb  1 12:00:00 2010']:
+        try:
+            sp.parse_date(d)
+            assert(False)
+        except ValueError:
+            pass
+
+
+def timeindex_test():
+    import StringIO
+    with open(datadir + 'oneline.spec') as fid:
+        text = fid.read()
+    header, scan = text.split('\n\n')
+    dates = ['13:00:00', '14:00:00', '15:00:00', '11:00:00', '12:00:00',
+             '16:00:00']
+    spec = header + '\n'
+    for i, d in enumerate(dates):
+        spec += '\n' + scan.replace('#S 1 ', '#S %d ' % (i+1)) \
+            .replace('13:43:23', d)
+    scans = sp.Specparser(StringIO.StringIO(spec)).parse()
+    assert(scans.order == [ (i+1, 0) for i in range(len(dates)) ])
+    tind = sp.TimeIndex(scans)
+    assert(len(tind.runs) == 2)
+    t = lambda hms: sp.parse_date('Thu Nov 23 %s 2000' % hms)
+    assert(tind.scans_between(t('13:30:00'), t('15:00:00')) == [(2, 0), (3, 0)])
+    assert(tind.scans_between(t('11:30:00'), t('13:00:00')) == [(1, 0), (5, 0)])
+    assert(tind.scans_between(t('00:00:00'), t('23:00:00')) == scans.order)
+    assert(tind.scans_between(t('17:00:00'), t('18:00:00')) == [])
+    t0 = datetime.datetime(2000, 11, 23, 15, 30)
+    t1 = datetime.datetime(2000, 11, 23, 16, 30)
+    assert(tind.scans_between(t0, t1) == [(6, 0)])
+    assert(scans[6]['date'] == datetime.datetime(2000, 11, 23, 16, 0, 0))
+    # Scans without file order, e.g. unpickled
+    del scans.order
+    assert(sp.TimeIndex(scans).scans_between(t0, t1) == [(6, 0)])
+    import pickle
+    with open(datadir + 'mini.pickle') as fp:
+        pscns = pickle.load(fp)
+    assert(not hasattr(pscns, 'order'))
+    keys = sp.TimeIndex(pscns).scans_between(0, time.time())
+    assert(sorted(keys) == sorted(pscns.keys()))
+
+
+def dtypes_test():
+    import array
+    with open(datadir + 'simple.spec') as fid:
+        full = sp.Specparser(fid).parse()
+    for policy in ('auto', 'float32'):
+        with open(datadir + 'simple.spec') as fid:
+            p = sp.Specparser(fid)
+            p.dtypes = { None : policy, 'Seconds' : 'd' }
+            scans = p.parse()
+        for k in full.keys():
+            s, fs = scans[k], full[k]
+            assert(set(s['dtypes'].keys()) == set(s['columns']))
+            for c in s['columns']:
+                vals, tc = s['counters'][c], s['dtypes'][c]
+                assert(isinstance(vals, array.array) and vals.typecode == tc)
+                if c == 'Seconds':
+                    assert(tc == 'd')
+                elif all(v.is_integer() for v in fs['counters'][c]):
+                    assert(tc in ('i', 'l'))
+                else:
+                    assert(tc == ('f' if policy == 'float32' else 'd'))
+                if tc != 'f':
+                    assert(vals.tolist() == fs['counters'][c])
+                assert(sp.lossless(fs['counters'][c], tc) == \
+                    (vals.tolist() == fs['counters'][c]))
+        assert(scans[2]['dtypes']['Detector'] == 'i')
+    assert(sp.lossless([1.0, 2.0, -3.0], 'i'))
+    assert(not sp.lossless([1.5], 'i'))
+    assert(not sp.lossless([2.0**40], 'i'))
+    assert(sp.lossless([0.5, 0.25], 'f'))
+    assert(not sp.lossless([0.1], 'f'))
+    # Integer overrides are not applied to non-integer values
+    with open(datadir + 'simple.spec') as fid:
+        p = sp.Specparser(fid)
+        p.dtypes = { 'H' : 'i', 'Detector' : 'h' }
+        scans = p.parse()
+    assert(scans[1]['dtypes']['H'] == 'd')
+    assert(scans[1]['counters']['H'].tolist() == full[1]['counters']['H'])
+    assert(scans[2]['dtypes']['Detector'] == 'h')
+    # Single precision floats do not overflow to infinity
+    big = array.array('d', [1e300, 0.5])
+    assert(sp._convert_counter(big, 'float32') is big)
+    assert(sp._convert_counter(big, 'f') is big)
+    assert(sp._convert_counter(array.array('d', [1e30, 0.5]), 'float32') \
+        .typecode == 'f')
+    # Unknown typecodes and policies
+    for tc in ('', 'iI', 'x', 'float64'):
+        try:
+            sp.lossless([1.0], tc)
+            assert(False)
+        except ValueError:
+            pass
+        with open(datadir + 'simple.spec') as fid:
+            p = sp.Specparser(fid)
+            p.dtypes = { 'H' : tc }
+            try:
+                p.parse()
+                assert(False)
+            except ValueError:
+                pass
+    # Shared memory stores counters as doubles
+    with sp.export_shared(scans) as desc:
+        shared = desc.attach()
+        assert(set(shared[2]['dtypes'].values()) == set(['d']))
+        desc.detach(shared)
+
+
+def spec2pickle_test():
+    import os, tempfile, pickle, spec2pickle
+    with open(datadir + 'simple.spec') as fid:
+        scans = sp.Specparser(fid).parse()
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        spec2pickle.spec2pickle(datadir + 'simple.spec', fname)
+        plain = os.path.getsize(fname)
+        spec2pickle.spec2pickle(datadir + 'simple.spec', fname, 'auto')
+        assert(os.path.getsize(fname) < plain)
+        with open(fname) as fp:
+            pscns = pickle.load(fp)
+        for k in scans.keys():
+            for c, vals in scans[k]['counters'].items():
+                assert(pscns[k]['counters'][c].tolist() == vals)
+        # Pickling of arrays elsewhere is not affected
+        import array, copy_reg
+        assert(array.array not in copy_reg.dispatch_table)
+        # Arrays written on a machine with other byte order or item size
+        import struct
+        for order, fmt in (('little', '<3i'), ('big', '>3i'),
+                           ('little', '<3q'), ('big', '>3q')):
+            data = struct.pack(fmt, 1, -2, 3)
+            size = struct.calcsize(fmt) // 3
+            for tc in ('i', 'l'):
+                arr = sp._rebuild_array(tc, data, order, size)
+                assert(arr.typecode == tc and arr.tolist() == [1, -2, 3])
+        data = struct.pack('>2d', 0.5, -1e300)
+        assert(sp._rebuild_array('d', data, 'big', 8).tolist() == \
+            [0.5, -1e300])
+    finally:
+        os.unlink(fname)
+
+
+def motornames_cache_test():
+    import StringIO
+    for i in range(2*sp.MOTORNAMES_CACHESIZE):
+        spec = '#F x\n#O0 m%d  other\n\n' % i
+        h = sp.Specparser(StringIO.StringIO(spec)).header()
+        assert(h['motornames'] == ['m%d' % i, 'other'])
+    assert(len(sp._motornames_cache) == sp.MOTORNAMES_CACHESIZE)
+
+
+def accumulator_zero_norm_test():
+    with open(datadir + 'simple.spec') as fid:
+        full = sp.Specparser(fid).parse()
+    with open(datadir + 'simple.spec') as fid:
+        p = sp.Specparser(fid)
+        assert(p.summary() == {})
+        # Monitor is zero at every point, Detector at some
+        p.accumulators = { 'mon' : sp.Sum('Detector', norm='Monitor'),
+                           'mean' : sp.Mean('Seconds', norm='Detector') }
+        scans = p.parse()
+    for k in full.keys():
+        det = full[k]['counters']['Detector']
+        secs = full[k]['counters']['Seconds']
+        assert(scans[k]['summary']['mon'] == 0.0)
+        nz = [ s/d for s, d in zip(secs, det) if d != 0.0 ]
+        if nz:
+            assert(abs(scans[k]['summary']['mean'] - sum(nz)/len(nz)) < 1e-9)
+        else:
+            assert(scans[k]['summary']['mean'] == None)
+
+
+def mca_end_test():
+    import StringIO
+    with open(datadir + 'oneline.spec') as fid:
+        text = fid.read()
+    spectrum = '@A 1 2 3\\\n 4 5\n'
+    # Input ends after a complete spectrum, before its point
+    scans = sp.Specparser(StringIO.StringIO(text + spectrum)).parse()
+    assert(len(scans) == 1)
+    assert(scans[1]['npoints'] == 1)
+    assert(list(scans[1]['mca_unpaired'][0]) == [1, 2, 3, 4, 5])
+    # Input ends in the middle of a spectrum of the second scan
+    scan2 = text.split('\n\n')[1].replace('#S 1 ', '#S 2 ')
+    spec = text + '\n' + scan2 + spectrum + '@A 1 2 3\\\n'
+    scans = sp.Specparser(StringIO.StringIO(spec)).parse()
+    assert(len(scans) == 2)
+    assert(scans[2]['npoints'] == 1)
+    assert('mca' not in scans[2])
+    assert(len(scans[2]['mca_unpaired']) == 1)
+    # Spectra before the end of a scan are kept
+    spec = text + spectrum + '\n' + scan2
+    scans = sp.Specparser(StringIO.StringIO(spec)).parse()
+    assert(len(scans[1]['mca_unpaired']) == 1)
+    assert('mca_unpaired' not in scans[2])
+
+
+def decode_mca_test():
+    text = ' 1 2\n 3e2  -4.5 '
+    assert(list(sp.decode_mca(text)) == [1, 2, 300, -4.5])
+    numpy = sp.numpy
+    try:
+        sp.numpy = None
+        assert(list(sp.decode_mca(text)) == [1, 2, 300, -4.5])
+    finally:
+        sp.numpy = numpy
+    # Malformed values which numpy.fromstring() would silently drop
+    for text in ('1 2 x 4', '1 2 - 3', '1e 2', '+ 1', '1 2 3.4.5', '1 2-'):
+        try:
+            sp.decode_mca(text)
+            assert(False)
+        except ValueError:
+            pass
+
+
+def timeout_test():
+    with open(datadir + 'oneline.spec') as fid:
+        lines = fid.readlines()
+    class Growing(object):
+        # Returns the lines one by one, with no input available in between
+        def __init__(self):
+            self.waiting = True
+            self.lines = list(lines)
+        def next(self):
+            self.waiting = not self.waiting
+            if self.waiting or not self.lines:
+                raise StopIteration
+            return self.lines.pop(0)
+        def close(self):
+            pass
+    waittime = sp.WAITTIME
+    sp.WAITTIME = 0.001
+    try:
+        p = sp.Specparser(Growing())
+        p.timeout = 0.5
+        scans = p.parse()
+    finally:
+        sp.WAITTIME = waittime
+    assert(p.lineno == len(lines) - 1)
+    assert(scans[1]['npoints'] == 1)
+    assert(scans[1]['counters']['Detector'] == [1.0])
+    assert(scans[1]['date'] == datetime.datetime(2000, 11, 23, 13, 43, 23))
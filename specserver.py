@@ -0,0 +1,408 @@
+"""Server which follows growing spec-files and publishes their contents.
+
+Each followed spec-file is read by a single :class:`Specparser` running
+in its own thread. New file headers, scan headers, scan points and
+comments are pushed as JSON messages, one per line, to every client
+subscribed to the file. The server listens on a Unix socket (if the
+address is a string) or on a TCP socket (if the address is a
+(host, port) tuple, e.g. ('localhost', 5555)).
+
+A client subscribes by connecting and sending the path of the followed
+spec-file, terminated by a newline. Messages are dictionaries with the
+key 'type' being one of
+
+==========  =============================================================
+type        other keys
+==========  =============================================================
+snapshot    'header': dict of the file header (see
+            :meth:`Specparser.header`), 'scan': dict of the current scan
+            header or None, 'points': list of points in the current scan.
+header      'header': dict of a new file header.
+scan        'scan': dict of a new scan header (see
+            :meth:`Specparser.next_scan_header`).
+point       'number': scan number, 'pointno': index of the point in the
+            scan, 'point': list of counter values.
+comment     'number': scan number, 'comment': [lineno, commentline,
+            pointno] list.
+end         'number': scan number, 'npoints': number of points.
+error       'error': error message string.
+==========  =============================================================
+
+The first message sent to a subscriber is a snapshot. Messages for each
+subscriber are queued in a queue of at most :attr:`SpecServer.maxqueue`
+(at least 2) messages. If a subscriber does not keep up and its queue
+fills, the queued messages are discarded and replaced by a new snapshot.
+An 'end' or 'error' message which does not fit is queued after the
+snapshot, so that the subscriber still sees the end of the scan or the
+error.
+
+Scan headers are parsed only when the first point of the scan (or the
+next control line) is written, so a 'scan' message is sent just before
+the first 'point' message of the scan.
+"""
+from __future__ import with_statement
+import sys, os, socket, threading, json, datetime, logging, Queue
+import SocketServer
+import specparser
+
+POLLTIME = 0.05
+
+
+def _jsondefault(o):
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    raise TypeError(repr(o))
+
+def encode(msg):
+    """Return a message dictionary as a JSON string with a newline."""
+    return json.dumps(msg, separators=(',', ':'), default=_jsondefault) + '\n'
+
+
+class _TailFile(object):
+    """Iterator over lines of a growing file.
+
+    Blocks until a complete line is available. Raises StopIteration
+    only after the `stop` event is set.
+    """
+    def __init__(self, path, stop, polltime=POLLTIME):
+        self.fid = open(path)
+        self.stop = stop
+        self.polltime = polltime
+        self.buf = ''
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            line = self.fid.readline()
+            if line:
+                self.buf = self.buf + line
+                if line.endswith('\n'):
+                    line, self.buf = self.buf, ''
+                    return line
+            elif self.stop.is_set():
+                raise StopIteration
+            else:
+                self.stop.wait(self.polltime)
+
+    def close(self):
+        self.fid.close()
+
+
+class _Publisher(specparser.Accumulator):
+    """Accumulator which passes each scan point to a follower."""
+    def __init__(self, follower):
+        specparser.Accumulator.__init__(self, None)
+        self.follower = follower
+
+    def reset(self, columns):
+        return True
+
+    def add(self, pts):
+        self.follower._point(pts)
+
+    def value(self):
+        return None
+
+
+class _Subscriber(object):
+    """Bounded message queue of a single client."""
+    def __init__(self, maxqueue):
+        # Room for a snapshot and the message which overflowed the queue
+        self.queue = Queue.Queue(max(maxqueue, 2))
+
+
+class Follower(threading.Thread):
+    """Thread which follows a single spec-file and publishes its contents
+    to subscribers.
+
+    Scan points are not stored, except for the points of the current
+    scan, which are needed for snapshots.
+
+    If the file can not be read or parsed, the follower stops and
+    :attr:`error` is set to the error message, which is sent to all
+    current and later subscribers after their snapshot.
+    """
+    def __init__(self, path, maxqueue=1000, polltime=POLLTIME):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.maxqueue = maxqueue
+        self.polltime = polltime
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.header = {}
+        self.scan = None
+        self.points = []
+        self.comments = []
+        self.parser = None
+        self.error = None
+        self.__nheaders = 0
+
+    def subscribe(self):
+        """Return a new subscriber, whose queue starts with a snapshot."""
+        sub = _Subscriber(self.maxqueue)
+        with self.lock:
+            sub.queue.put(self.snapshot())
+            if self.error != None:
+                sub.queue.put({ 'type' : 'error', 'error' : self.error })
+            else:
+                self.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def snapshot(self):
+        """Return a snapshot message. Call with :attr:`lock` held."""
+        scan = self.scan
+        if scan != None:
+            scan = dict(scan)
+            scan['comments'] = list(self.comments)
+        return { 'type' : 'snapshot', 'header' : self.header,
+                 'scan' : scan, 'points' : list(self.points) }
+
+    def stop(self):
+        self.stopped.set()
+
+    def __publish(self, msg):
+        # Called with self.lock held
+        for sub in self.subscribers:
+            try:
+                sub.queue.put_nowait(msg)
+            except Queue.Full:
+                logging.warning('Subscriber of %s overflowed' % self.path)
+                try:
+                    while True:
+                        sub.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                sub.queue.put_nowait(self.snapshot())
+                # The snapshot does not tell that the scan has ended
+                # or that following the file failed
+                if msg['type'] in ('end', 'error'):
+                    sub.queue.put_nowait(msg)
+
+    def __check_headers(self):
+        p = self.parser
+        while self.__nheaders < len(p.headers):
+            hdict = p.headers[self.__nheaders][1]
+            self.__nheaders += 1
+            self.header = dict(self.header)
+            self.header.update(hdict)
+            self.__publish({ 'type' : 'header', 'header' : hdict })
+
+    def __check_comments(self):
+        comments = self.parser.curscan['comments']
+        while len(self.comments) < len(comments):
+            c = comments[len(self.comments)]
+            self.comments.append(c)
+            self.__publish({ 'type' : 'comment',
+                'number' : self.scan.get('number'), 'comment' : c })
+
+    def _point(self, pts):
+        with self.lock:
+            self.__check_comments()
+            self.points.append(pts)
+            self.__publish({ 'type' : 'point',
+                'number' : self.scan.get('number'),
+                'pointno' : len(self.points) - 1, 'point' : pts })
+
+    def run(self):
+        try:
+            tail = _TailFile(self.path, self.stopped, self.polltime)
+            self.parser = p = specparser.Specparser(tail)
+            p.accumulators = { 'publisher' : _Publisher(self) }
+            while True:
+                p.next_scan_header()
+                with self.lock:
+                    self.__check_headers()
+                    self.scan = dict([ (k, v) for k, v in p.curscan.items()
+                            if k not in ('counters', 'summary') ])
+                    self.scan['comments'] = list(self.scan['comments'])
+                    self.points = []
+                    self.comments = list(self.scan['comments'])
+                    self.__publish({ 'type' : 'scan', 'scan' : self.scan })
+                try:
+                    while True:
+                        p.next_point()
+                except specparser.ScanEnd:
+                    pass
+                with self.lock:
+                    self.__check_comments()
+                    self.__publish({ 'type' : 'end',
+                        'number' : self.scan.get('number'),
+                        'npoints' : len(self.points) })
+        except specparser.InputTimeout:
+            # Stop was requested
+            pass
+        except Exception as e:
+            logging.error('Error following %s: %s' % (self.path, repr(e)))
+            with self.lock:
+                self.error = repr(e)
+                self.__publish({ 'type' : 'error', 'error' : self.error })
+                self.subscribers = []
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        server = self.server.specserver
+        with server.lock:
+            server.handlers.append(threading.current_thread())
+        try:
+            self.__serve(server)
+        finally:
+            with server.lock:
+                server.handlers.remove(threading.current_thread())
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # Client has disconnected
+            pass
+
+    def __serve(self, server):
+        path = self.rfile.readline().strip()
+        follower = server.followers.get(path)
+        if follower == None:
+            self.wfile.write(encode({ 'type' : 'error',
+                'error' : 'Not following %s' % path }))
+            return
+        sub = follower.subscribe()
+        try:
+            while not server.stopped.is_set():
+                try:
+                    msg = sub.queue.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                self.wfile.write(encode(msg))
+                self.wfile.flush()
+                if msg['type'] == 'error':
+                    break
+        except socket.error:
+            pass
+        finally:
+            follower.unsubscribe(sub)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(SocketServer, 'UnixStreamServer'):
+    class _UnixServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+
+class SpecServer:
+    """Publishes the contents of growing spec-files to subscribed clients.
+
+    Instance variables:
+
+    :attr:`address`
+        Unix socket path (string) or (host, port) tuple of the server.
+        If the port is 0, the actual port is set when the server starts.
+
+    :attr:`followers`
+        Dictionary of :class:`Follower` instances keyed by file path.
+
+    :attr:`maxqueue`
+        Maximum number of messages queued for a single subscriber.
+    """
+    def __init__(self, address, paths=[], maxqueue=1000, polltime=POLLTIME):
+        self.address = address
+        self.maxqueue = maxqueue
+        self.polltime = polltime
+        self.followers = {}
+        self.stopped = threading.Event()
+        # Threads serving the clients
+        self.handlers = []
+        self.lock = threading.Lock()
+        self.__server = None
+        for path in paths:
+            self.add_file(path)
+
+    def add_file(self, path):
+        """Start following the spec-file in `path`."""
+        if path in self.followers:
+            return
+        f = Follower(path, self.maxqueue, self.polltime)
+        self.followers[path] = f
+        f.start()
+
+    def start(self):
+        """Start serving clients in a background thread."""
+        if isinstance(self.address, tuple):
+            self.__server = _TCPServer(self.address, _Handler)
+            self.address = self.__server.server_address
+        else:
+            self.__server = _UnixServer(self.address, _Handler)
+        self.__server.specserver = self
+        t = threading.Thread(target=self.__server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        """Stop the server and all followers."""
+        self.stopped.set()
+        for f in self.followers.values():
+            f.stop()
+        if self.__server != None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            if not isinstance(self.address, tuple):
+                os.unlink(self.address)
+        for f in self.followers.values():
+            f.join()
+        with self.lock:
+            handlers = list(self.handlers)
+        for t in handlers:
+            t.join()
+
+
+def subscribe(address, path):
+    """Connect to a :class:`SpecServer` and return an iterator over the
+    messages (dictionaries) published for the spec-file `path`.
+
+    The connection is closed when the iterator is closed.
+    """
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    sock.sendall(path + '\n')
+    fid = sock.makefile('r')
+    sock.close()
+    try:
+        for line in fid:
+            yield json.loads(line)
+    finally:
+        fid.close()
+
+
+def main():
+    """Usage: specserver.py ADDRESS SPECFILE...
+
+    ADDRESS is a Unix socket path or a host:port pair.
+    """
+    addr = sys.argv[1]
+    if ':' in addr:
+        host, port = addr.rsplit(':', 1)
+        addr = (host, int(port))
+    server = SpecServer(addr, sys.argv[2:])
+    server.start()
+    try:
+        while True:
+            server.stopped.wait(1.0)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()